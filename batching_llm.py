@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import litellm
+from langchain_community.chat_models import ChatLiteLLM
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# How long a call waits for companions before its batch is flushed, and the
+# batch size that triggers an immediate flush. The independent role crews
+# fan out concurrently, so their completion calls tend to land within the
+# same few milliseconds and coalesce into one provider round-trip.
+BATCH_WINDOW_SECONDS = float(os.getenv("CREW_LLM_BATCH_WINDOW", "0.05"))
+MAX_BATCH_SIZE = int(os.getenv("CREW_LLM_MAX_BATCH", "8"))
+
+_ROLE_MAP = {"human": "user", "ai": "assistant", "system": "system"}
+
+def _to_openai_messages(messages: List[BaseMessage]) -> List[Dict[str, str]]:
+    """Convert langchain messages to the OpenAI-style dicts litellm expects."""
+    return [
+        {"role": _ROLE_MAP.get(message.type, "user"), "content": message.content}
+        for message in messages
+    ]
+
+class _PendingCall:
+    """A buffered completion call waiting for its batch to be flushed."""
+
+    __slots__ = ("messages", "stop", "params", "event", "result", "error")
+
+    def __init__(self, messages: List[Dict[str, str]], stop: Optional[List[str]],
+                 params: Optional[Dict[str, Any]]):
+        self.messages = messages
+        self.stop = stop
+        self.params = params or {}
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class _CompletionBatcher:
+    """
+    Buffers concurrent completion calls and flushes them as one batch.
+
+    The first call to arrive starts a flush timer; calls arriving within
+    the window join its batch. A full batch (MAX_BATCH_SIZE) flushes
+    immediately. All calls in a batch share the model, invocation params
+    and stop sequences, which holds here because every agent's LLM is a
+    copy of one template with identical stop words.
+    """
+
+    def __init__(self, model: str):
+        self._model = model
+        self._lock = threading.Lock()
+        self._pending: List[_PendingCall] = []
+        self._flusher: Optional[threading.Thread] = None
+
+    def submit(self, messages: List[Dict[str, str]], stop: Optional[List[str]] = None,
+               params: Optional[Dict[str, Any]] = None) -> Any:
+        """Queue one completion call and block until its batch returns."""
+        call = _PendingCall(messages, stop, params)
+        flush_now = None
+        with self._lock:
+            self._pending.append(call)
+            if len(self._pending) >= MAX_BATCH_SIZE:
+                flush_now, self._pending = self._pending, []
+            elif self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_after_window, daemon=True)
+                self._flusher.start()
+
+        if flush_now:
+            self._dispatch(flush_now)
+
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _flush_after_window(self):
+        time.sleep(BATCH_WINDOW_SECONDS)
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._flusher = None
+        if batch:
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[_PendingCall]):
+        kwargs = dict(batch[0].params)
+        if batch[0].stop:
+            kwargs["stop"] = batch[0].stop
+        try:
+            responses = litellm.batch_completion(
+                model=self._model,
+                messages=[call.messages for call in batch],
+                **kwargs
+            )
+        except Exception as e:
+            for call in batch:
+                call.error = e
+                call.event.set()
+            return
+
+        for call, response in zip(batch, responses):
+            if isinstance(response, Exception):
+                call.error = response
+            else:
+                call.result = response
+            call.event.set()
+
+# One batcher per model so calls against different models never mix
+_batchers: Dict[str, _CompletionBatcher] = {}
+_batchers_lock = threading.Lock()
+
+def _get_batcher(model: str) -> _CompletionBatcher:
+    with _batchers_lock:
+        batcher = _batchers.get(model)
+        if batcher is None:
+            batcher = _batchers[model] = _CompletionBatcher(model)
+        return batcher
+
+class BatchingChatLiteLLM(ChatLiteLLM):
+    """
+    ChatLiteLLM variant that coalesces concurrent calls into one batch.
+
+    Drop-in replacement for the agents' shared LLM: each _generate call
+    is routed through the per-model batcher, so independent tasks running
+    in the same gather tier share a single litellm.batch_completion
+    round-trip instead of paying HTTP and auth overhead per call.
+    """
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[Any] = None, **kwargs: Any) -> ChatResult:
+        # Forward the instance's invocation params (temperature, max_tokens,
+        # extra_headers from model_kwargs, ...) so batched calls behave
+        # exactly like direct ChatLiteLLM calls, not just share a transport
+        params = {**self._default_params, **kwargs}
+        params = {
+            k: v for k, v in params.items()
+            if v is not None and k not in ("model", "stream")
+        }
+        response = _get_batcher(self.model).submit(
+            _to_openai_messages(messages), stop=stop, params=params
+        )
+        content = response["choices"][0]["message"]["content"]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
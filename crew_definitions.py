@@ -1,7 +1,115 @@
+import asyncio
+import functools
 import os
-from typing import Dict, Any, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Dict, Any, Optional, List, Mapping
 from crewai import Agent, Task, Crew
 from crewai.process import Process
+from langchain_community.chat_models import ChatLiteLLM
+from langchain_core.messages import SystemMessage
+
+from batching_llm import BatchingChatLiteLLM
+
+# Agent/crew verbosity is off by default: verbose chains format and print
+# per-step strings on the hot path, which serializes concurrent requests
+# on the stdout lock. Set CREW_VERBOSE=1 (agents) or 2 (crews too) to debug.
+VERBOSE = int(os.getenv("CREW_VERBOSE", "0"))
+
+# Roles whose task chains consume no other role's output and can run concurrently.
+INDEPENDENT_ROLES = [
+    "Composer + Lyricist",
+    "Book",
+    "Choreographer",
+    "Set/Visual",
+    "Market/Producer"
+]
+
+# Roles that review or reconcile the other departments' work, so they run
+# only after the independent role crews have finished.
+DEPENDENT_ROLES = [
+    "Director",
+    "Dramaturg"
+]
+
+# Built once at import time; every agent creation reads from these rather
+# than re-allocating the descriptions per call.
+_ROLE_DESCRIPTIONS: Mapping[str, Mapping[str, str]] = MappingProxyType({
+    "Composer + Lyricist": {
+        "goal": "Create compelling musical numbers and lyrics that advance the story",
+        "backstory": "You are an experienced composer and lyricist with a deep understanding of musical theater conventions and the ability to create memorable melodies and meaningful lyrics."
+    },
+    "Book": {
+        "goal": "Develop a coherent and engaging narrative structure",
+        "backstory": "You are a skilled playwright with experience in crafting compelling stories and developing rich characters for musical theater."
+    },
+    "Director": {
+        "goal": "Unify the creative vision and guide the overall production",
+        "backstory": "You are a seasoned director with expertise in bringing together various theatrical elements into a cohesive whole."
+    },
+    "Choreographer": {
+        "goal": "Create dynamic movement that enhances the storytelling",
+        "backstory": "You are an innovative choreographer who specializes in creating movement that serves both the story and the music."
+    },
+    "Set/Visual": {
+        "goal": "Design compelling visual environments that support the narrative",
+        "backstory": "You are a creative designer with experience in creating immersive theatrical environments that enhance storytelling."
+    },
+    "Dramaturg": {
+        "goal": "Ensure historical accuracy and narrative consistency",
+        "backstory": "You are a meticulous researcher and story expert who helps maintain the integrity of the production."
+    },
+    "Market/Producer": {
+        "goal": "Develop effective marketing strategies and manage production resources",
+        "backstory": "You are an experienced producer with a strong understanding of theater marketing and production management."
+    }
+})
+
+_DEFAULT_ROLE_INFO: Mapping[str, str] = MappingProxyType({
+    "goal": "Contribute to the overall success of the production",
+    "backstory": "You are a theater professional with expertise in your specific domain."
+})
+
+# Structure-of-arrays layout for the production schema: roles and their
+# task templates as parallel tuples, so the crew-build loop iterates
+# positionally instead of hashing into a dict per role.
+_ROLE_TASKS = (
+    ("Composer + Lyricist", (
+        ("Compose new songs", "Sheet music and lyrics for all songs"),
+        ("Develop musical themes", "Musical motifs for characters and scenes"),
+        ("Create vocal arrangements", "Detailed vocal arrangements for ensemble")
+    )),
+    ("Book", (
+        ("Draft storyline", "Complete first draft of the book"),
+        ("Character development", "Detailed character backgrounds and arcs"),
+        ("Scene structure", "Scene-by-scene breakdown with transitions")
+    )),
+    ("Director", (
+        ("Review creative inputs", "Provide feedback on creative direction"),
+        ("Vision development", "Comprehensive production vision document"),
+        ("Staging concepts", "Initial staging plans for key scenes")
+    )),
+    ("Choreographer", (
+        ("Develop choreography", "Choreography plans for musical numbers"),
+        ("Movement patterns", "Character-specific movement guidelines"),
+        ("Dance arrangements", "Dance break arrangements for ensemble numbers")
+    )),
+    ("Set/Visual", (
+        ("Design set sketches", "Mood boards and initial sketches"),
+        ("Technical requirements", "Technical specifications for set pieces"),
+        ("Visual continuity", "Scene transition and visual flow plans")
+    )),
+    ("Dramaturg", (
+        ("Check continuity", "A list of suggested storyline adjustments"),
+        ("Historical research", "Period-specific reference materials"),
+        ("Theme analysis", "Analysis of major themes and motifs")
+    )),
+    ("Market/Producer", (
+        ("Analyze market trends", "Market analysis report"),
+        ("Budget planning", "Initial budget breakdown"),
+        ("Marketing strategy", "Marketing and promotion plan")
+    ))
+)
 
 class MusicalTheaterCrew:
     """
@@ -10,57 +118,98 @@ class MusicalTheaterCrew:
     This class manages the creation and organization of agents and tasks
     for a musical theater production crew.
     """
-    
+
+    # Only the per-instance registries live on instances; dropping
+    # __dict__ shrinks each instance and speeds up attribute access
+    # when many coexist under concurrent requests.
+    __slots__ = ("agents", "tasks")
+
+    # Fixed production schema, shared by all instances and derived from the
+    # positional _ROLE_TASKS layout; the mapping view exists for callers
+    # that look templates up by role name.
+    roles = tuple(role for role, _ in _ROLE_TASKS)
+    task_templates: Mapping[str, tuple] = MappingProxyType(dict(_ROLE_TASKS))
+
     def __init__(self):
         self.agents = {}
         self.tasks = {}
-        self.roles = [
-            "Composer + Lyricist",
-            "Book",
-            "Director",
-            "Choreographer",
-            "Set/Visual",
-            "Dramaturg",
-            "Market/Producer"
-        ]
-        
-        self.task_templates = {
-            "Composer + Lyricist": [
-                ("Compose new songs", "Sheet music and lyrics for all songs"),
-                ("Develop musical themes", "Musical motifs for characters and scenes"),
-                ("Create vocal arrangements", "Detailed vocal arrangements for ensemble")
-            ],
-            "Book": [
-                ("Draft storyline", "Complete first draft of the book"),
-                ("Character development", "Detailed character backgrounds and arcs"),
-                ("Scene structure", "Scene-by-scene breakdown with transitions")
-            ],
-            "Director": [
-                ("Review creative inputs", "Provide feedback on creative direction"),
-                ("Vision development", "Comprehensive production vision document"),
-                ("Staging concepts", "Initial staging plans for key scenes")
-            ],
-            "Choreographer": [
-                ("Develop choreography", "Choreography plans for musical numbers"),
-                ("Movement patterns", "Character-specific movement guidelines"),
-                ("Dance arrangements", "Dance break arrangements for ensemble numbers")
-            ],
-            "Set/Visual": [
-                ("Design set sketches", "Mood boards and initial sketches"),
-                ("Technical requirements", "Technical specifications for set pieces"),
-                ("Visual continuity", "Scene transition and visual flow plans")
-            ],
-            "Dramaturg": [
-                ("Check continuity", "A list of suggested storyline adjustments"),
-                ("Historical research", "Period-specific reference materials"),
-                ("Theme analysis", "Analysis of major themes and motifs")
-            ],
-            "Market/Producer": [
-                ("Analyze market trends", "Market analysis report"),
-                ("Budget planning", "Initial budget breakdown"),
-                ("Marketing strategy", "Marketing and promotion plan")
-            ]
-        }
+
+def _mark_cache_breakpoint(messages: List[Any]) -> List[Any]:
+    """
+    Rewrite a leading system message into block form with a cache breakpoint.
+
+    Anthropic caches nothing unless a content block carries an explicit
+    cache_control marker, so the static system/backstory block is wrapped
+    as a text block tagged {"type": "ephemeral"}. Prompts without a
+    leading plain-text system message pass through untouched.
+
+    Args:
+        messages: The langchain messages about to be sent to the model
+
+    Returns:
+        The messages with the system block marked for caching
+    """
+    if messages and messages[0].type == "system" and isinstance(messages[0].content, str):
+        block = [{
+            "type": "text",
+            "text": messages[0].content,
+            "cache_control": {"type": "ephemeral"}
+        }]
+        return [SystemMessage(content=block), *messages[1:]]
+    return list(messages)
+
+class _PromptCachingMixin:
+    """Marks the static system block for Anthropic prompt caching before each call."""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return super()._generate(_mark_cache_breakpoint(messages), stop=stop,
+                                 run_manager=run_manager, **kwargs)
+
+class _PromptCachingChatLiteLLM(_PromptCachingMixin, ChatLiteLLM):
+    pass
+
+class _PromptCachingBatchingChatLiteLLM(_PromptCachingMixin, BatchingChatLiteLLM):
+    pass
+
+# Template LLM instance, built lazily so .env is loaded first; agents
+# receive per-agent copies of it (see create_agent_for_role)
+_agent_llm: Optional[ChatLiteLLM] = None
+
+def _get_agent_llm() -> Optional[ChatLiteLLM]:
+    """
+    Return the template LLM for agents, or None for the CrewAI default.
+
+    Each agent's goal + backstory is a long static prompt prefix that is
+    re-sent on every task call, so prompt caching pays off immediately.
+    OpenAI models cache identical prefixes automatically; Anthropic and
+    Bedrock Claude models need both the prompt-caching beta header and an
+    explicit cache_control breakpoint on the static block, so Claude
+    models get a variant that injects the breakpoint per call.
+
+    Returns:
+        A ChatLiteLLM instance when CREW_MODEL is set, otherwise None
+    """
+    global _agent_llm
+    if _agent_llm is not None:
+        return _agent_llm
+
+    model = os.getenv("CREW_MODEL")
+    if not model:
+        return None
+
+    caching = "claude" in model or "anthropic" in model
+    model_kwargs = {}
+    if caching:
+        model_kwargs["extra_headers"] = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+    # With CREW_BATCH_LLM set, concurrent completion calls from the
+    # fanned-out role crews coalesce into single batched round-trips
+    if os.getenv("CREW_BATCH_LLM"):
+        llm_cls = _PromptCachingBatchingChatLiteLLM if caching else BatchingChatLiteLLM
+    else:
+        llm_cls = _PromptCachingChatLiteLLM if caching else ChatLiteLLM
+    _agent_llm = llm_cls(model=model, model_kwargs=model_kwargs)
+    return _agent_llm
 
 def create_agent_for_role(role: str) -> Agent:
     """
@@ -72,50 +221,83 @@ def create_agent_for_role(role: str) -> Agent:
     Returns:
         A configured Agent object for the role
     """
-    role_descriptions = {
-        "Composer + Lyricist": {
-            "goal": "Create compelling musical numbers and lyrics that advance the story",
-            "backstory": "You are an experienced composer and lyricist with a deep understanding of musical theater conventions and the ability to create memorable melodies and meaningful lyrics."
-        },
-        "Book": {
-            "goal": "Develop a coherent and engaging narrative structure",
-            "backstory": "You are a skilled playwright with experience in crafting compelling stories and developing rich characters for musical theater."
-        },
-        "Director": {
-            "goal": "Unify the creative vision and guide the overall production",
-            "backstory": "You are a seasoned director with expertise in bringing together various theatrical elements into a cohesive whole."
-        },
-        "Choreographer": {
-            "goal": "Create dynamic movement that enhances the storytelling",
-            "backstory": "You are an innovative choreographer who specializes in creating movement that serves both the story and the music."
-        },
-        "Set/Visual": {
-            "goal": "Design compelling visual environments that support the narrative",
-            "backstory": "You are a creative designer with experience in creating immersive theatrical environments that enhance storytelling."
-        },
-        "Dramaturg": {
-            "goal": "Ensure historical accuracy and narrative consistency",
-            "backstory": "You are a meticulous researcher and story expert who helps maintain the integrity of the production."
-        },
-        "Market/Producer": {
-            "goal": "Develop effective marketing strategies and manage production resources",
-            "backstory": "You are an experienced producer with a strong understanding of theater marketing and production management."
-        }
-    }
-    
-    role_info = role_descriptions.get(role, {
-        "goal": "Contribute to the overall success of the production",
-        "backstory": "You are a theater professional with expertise in your specific domain."
-    })
-    
+    role_info = _ROLE_DESCRIPTIONS.get(role, _DEFAULT_ROLE_INFO)
+
+    # Only pass llm= when a model is configured: an explicit llm=None
+    # bypasses crewai's default factory and crashes agent construction.
+    # Each agent gets its own shallow copy with a fresh callbacks list —
+    # crewai appends a token-counting handler to llm.callbacks per agent,
+    # which on the shared singleton would grow the handler chain without
+    # bound and cross-attribute token accounting between requests. The
+    # pooled HTTP transport is still shared via litellm's global sessions.
+    agent_kwargs: Dict[str, Any] = {}
+    llm = _get_agent_llm()
+    if llm is not None:
+        agent_kwargs["llm"] = llm.copy(update={"callbacks": None})
+
     return Agent(
         role=role,
         goal=role_info["goal"],
         backstory=role_info["backstory"],
-        verbose=True,
-        allow_delegation=True
+        verbose=bool(VERBOSE),
+        allow_delegation=True,
+        **agent_kwargs
     )
 
+# Dedicated pool for blocking crew-setup work, so agent construction never
+# competes with other users of asyncio's shared default executor and the
+# event loop stays responsive for health checks and queued requests.
+_SETUP_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CREW_SETUP_WORKERS", "8")),
+    thread_name_prefix="crew-setup"
+)
+
+# Crew execution is synchronous in the pinned crewai release, so kickoffs
+# get their own pool: runs last minutes, and parking them on the setup
+# pool or asyncio's default executor would starve everything else.
+_KICKOFF_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CREW_KICKOFF_WORKERS", "32")),
+    thread_name_prefix="crew-kickoff"
+)
+
+async def _akickoff(crew: Crew, inputs: Dict[str, Any]) -> str:
+    """
+    Run a crew's synchronous kickoff without blocking the event loop.
+
+    The pinned crewai release has no async kickoff API, so the run is
+    dispatched to the dedicated kickoff executor and awaited.
+
+    Args:
+        crew: The crew to run
+        inputs: The inputs interpolated into the crew's task descriptions
+
+    Returns:
+        The crew's final output
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _KICKOFF_EXECUTOR, functools.partial(crew.kickoff, inputs=inputs)
+    )
+
+async def _acreate_agent(role: str) -> Agent:
+    """
+    Create an agent for a role without blocking the event loop.
+
+    Agent construction can perform I/O-bound setup (LLM client
+    initialization, tool registration), so it runs on the dedicated setup
+    executor; gathering several of these overlaps the per-agent setup
+    cost. Agents are always built fresh: crew execution reconfigures its
+    agents in place, so instances must never back concurrent crews.
+
+    Args:
+        role: The specific role in the musical theater production
+
+    Returns:
+        A configured Agent object for the role
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_SETUP_EXECUTOR, create_agent_for_role, role)
+
 def create_task_for_role(agent: Agent, task_desc: tuple) -> Task:
     """
     Create a task for a specific role.
@@ -137,38 +319,142 @@ def create_task_for_role(agent: Agent, task_desc: tuple) -> Task:
 def create_musical_theater_crew(production_name: str) -> Crew:
     """
     Create a crew for a musical theater production.
-    
+
+    Agents and Task objects are built fresh on every call: crew execution
+    mutates both in place (executors reconfigured, delegation tools
+    appended, outputs assigned), so reusing them would leak prior-run
+    state between crews.
+
     Args:
         production_name: The name of the musical theater production
-        
+
     Returns:
         A configured Crew object with all necessary agents and tasks
     """
-    crew_manager = MusicalTheaterCrew()
     agents = []
     tasks = []
-    
-    # Create agents and tasks for each role
-    for role in crew_manager.roles:
+
+    # Create agents and tasks for each role, iterating the positional
+    # schema directly rather than hashing into a dict per role
+    for role, role_tasks in _ROLE_TASKS:
         agent = create_agent_for_role(role)
         agents.append(agent)
-        
-        # Create tasks for this role
-        role_tasks = crew_manager.task_templates.get(role, [])
-        for task_desc in role_tasks:
-            task = create_task_for_role(agent, task_desc)
-            tasks.append(task)
-    
-    # Create the crew with all agents and tasks
+        tasks.extend(create_task_for_role(agent, task_desc) for task_desc in role_tasks)
+
     crew = Crew(
         agents=agents,
         tasks=tasks,
-        verbose=2,
+        verbose=VERBOSE,
         process=Process.sequential
     )
-    
+
     return crew
 
+def create_role_crew(role: str, task_templates: tuple, context_note: Optional[str] = None,
+                     agent: Optional[Agent] = None, step_callback: Optional[Any] = None) -> Crew:
+    """
+    Create a small single-role crew whose tasks run sequentially.
+
+    Args:
+        role: The specific role in the musical theater production
+        task_templates: List of (description, expected_output) tuples for the role
+        context_note: Optional text appended to each task description,
+            used to hand dependent roles the output of earlier crews
+        agent: Optional pre-built agent for the role; created if omitted
+        step_callback: Optional callable invoked after each agent step,
+            used to stream intermediate progress back to the client
+
+    Returns:
+        A configured Crew object containing one agent and its tasks
+    """
+    if agent is None:
+        agent = create_agent_for_role(role)
+
+    # Task descriptions go through str.format during input interpolation,
+    # so braces in the departments' raw output (JSON, code, tables) must
+    # be escaped or the kickoff would raise KeyError/ValueError
+    if context_note:
+        context_note = context_note.replace("{", "{{").replace("}", "}}")
+
+    tasks = []
+    for description, expected_output in task_templates:
+        if context_note:
+            description = f"{description}\n\nOutput from the other departments:\n{context_note}"
+        tasks.append(Task(
+            description=description,
+            expected_output=expected_output,
+            agent=agent
+        ))
+
+    return Crew(
+        agents=[agent],
+        tasks=tasks,
+        verbose=VERBOSE,
+        process=Process.sequential,
+        step_callback=step_callback
+    )
+
+async def create_and_run_crews(inputs: Dict[str, Any], step_callback: Optional[Any] = None) -> str:
+    """
+    Run the musical theater production as concurrent per-role crews.
+
+    Tasks within a role stay sequential, but the independent role crews
+    (Composer, Book, Choreographer, Set/Visual, Market/Producer) fan out
+    concurrently with asyncio.gather. The Director and Dramaturg crews run
+    afterwards with the fanned-out results as context, since their tasks
+    review the other departments' output. Total wall time is roughly the
+    longest role chain plus the review phase, instead of the sum of all
+    21 task latencies.
+
+    Args:
+        inputs: The inputs passed to each crew's kickoff (production name etc.)
+        step_callback: Optional callable invoked after each agent step in
+            any role crew, used to stream intermediate progress
+
+    Returns:
+        The combined output of all role crews as a single string
+    """
+    # Build all agents concurrently up front; construction is I/O-bound.
+    # Agents are request-local: these crews run concurrently and crew
+    # execution reconfigures its agents in place, so shared agents would
+    # race and make a per-request step_callback stick to them for every
+    # later request. The expensive piece (the pooled HTTP transport) is
+    # still shared via litellm's global sessions.
+    all_roles = INDEPENDENT_ROLES + DEPENDENT_ROLES
+    agents = dict(zip(all_roles, await asyncio.gather(
+        *[_acreate_agent(role) for role in all_roles]
+    )))
+
+    # Phase 1: fan out the independent role crews concurrently
+    independent_crews = [
+        create_role_crew(role, MusicalTheaterCrew.task_templates.get(role, ()), agent=agents[role],
+                         step_callback=step_callback)
+        for role in INDEPENDENT_ROLES
+    ]
+    independent_results = await asyncio.gather(
+        *[_akickoff(crew, inputs) for crew in independent_crews]
+    )
+
+    # Phase 2: fan in, then run the reviewing roles with the results as context
+    context_note = "\n\n".join(
+        f"[{role}]\n{result}"
+        for role, result in zip(INDEPENDENT_ROLES, independent_results)
+    )
+    dependent_crews = [
+        create_role_crew(role, MusicalTheaterCrew.task_templates.get(role, ()), context_note=context_note,
+                         agent=agents[role], step_callback=step_callback)
+        for role in DEPENDENT_ROLES
+    ]
+    dependent_results = await asyncio.gather(
+        *[_akickoff(crew, inputs) for crew in dependent_crews]
+    )
+
+    all_results = zip(
+        INDEPENDENT_ROLES + DEPENDENT_ROLES,
+        list(independent_results) + list(dependent_results)
+    )
+    return "\n\n".join(f"=== {role} ===\n{result}" for role, result in all_results)
+
 # Example usage (uncomment to test locally):
 # if __name__ == "__main__":
 #     production_name = "New Musical Production"
@@ -1,30 +1,115 @@
 import os
+import json
+import hashlib
 import logging
-from typing import Dict, Any
-from fastapi import FastAPI, HTTPException, Depends
+import logging.handlers
+import queue
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from dotenv import load_dotenv
 import asyncio
+import httpx
+import litellm
 
 # Import CrewAI related functions
-from crew_definitions import create_musical_theater_crew
+from crew_definitions import create_and_run_crews
 
 # Load environment variables from .env file for local development
 load_dotenv()
 
-# Configure logging
+# Configure logging: records are handed to a queue and written by a
+# background listener thread, so log I/O never blocks the event loop
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
 )
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
 logger = logging.getLogger(__name__)
 
+# Check if required environment variables are set; env vars are static
+# after process start, so this runs once at boot rather than per request
+def _require_env(required_keys):
+    missing_keys = [key for key in required_keys if not os.getenv(key)]
+
+    if missing_keys:
+        error_msg = f"Missing required environment variables: {', '.join(missing_keys)}"
+        logger.error(error_msg)
+        raise RuntimeError(error_msg)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Manage process-wide resources for the app's lifetime.
+
+    Required API keys are validated here so a misconfigured deploy fails
+    at boot instead of 500-ing on every request. Every agent's LLM calls
+    go through LiteLLM, which by default opens a connection pool per
+    client. Sharing one httpx client (HTTP/2, bounded pool) across all
+    agents avoids repeated TCP+TLS handshakes and lets concurrent
+    requests multiplex streams to the provider.
+    """
+    _require_env(["OPENAI_API_KEY"])
+
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    app.state.http_client = httpx.AsyncClient(http2=True, limits=limits)
+    app.state.sync_http_client = httpx.Client(http2=True, limits=limits)
+    litellm.aclient_session = app.state.http_client
+    litellm.client_session = app.state.sync_http_client
+
+    # Optional shared result cache; without REDIS_URL an in-process
+    # TTL dict is used instead
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        import redis.asyncio as redis
+        app.state.redis = redis.from_url(redis_url, decode_responses=True)
+    else:
+        app.state.redis = None
+
+    # Warm the LLM path the crews actually use: a 1-token completion pays
+    # the TLS handshake and tokenizer load now instead of on the first
+    # real request. Warmup failure is logged, never fatal.
+    warmup_model = os.getenv("CREW_MODEL") or os.getenv("OPENAI_MODEL_NAME", "gpt-4")
+    try:
+        await asyncio.to_thread(
+            litellm.completion,
+            model=warmup_model,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+        )
+        logger.info("LLM connection warmed at startup (%s)", warmup_model)
+    except Exception as e:
+        logger.warning("LLM warmup failed: %s", e)
+
+    yield
+
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+    litellm.aclient_session = None
+    litellm.client_session = None
+    await app.state.http_client.aclose()
+    app.state.sync_http_client.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Musical Theater CrewAI API",
     description="API wrapper for Musical Theater CrewAI framework",
     version="1.0.0",
+    lifespan=lifespan,
+    # Crew results are multi-KB strings; orjson serializes them several
+    # times faster than the stdlib json encoder
+    default_response_class=ORJSONResponse,
 )
 
 # Add CORS middleware
@@ -36,71 +121,254 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Check if required environment variables are set
-def verify_api_keys():
-    required_keys = ["OPENAI_API_KEY"]
-    missing_keys = [key for key in required_keys if not os.getenv(key)]
-    
-    if missing_keys:
-        error_msg = f"Missing required environment variables: {', '.join(missing_keys)}"
-        logger.error(error_msg)
-        raise HTTPException(status_code=500, detail=error_msg)
-    
-    return True
+# Admission control: cap how many crews run at once so N concurrent POSTs
+# don't each spin up a 7-agent crew and trip provider rate limits. Requests
+# beyond the cap queue FIFO on the semaphore; past the queue limit they are
+# rejected with 503 instead of piling up. _crews_waiting counts only
+# requests still waiting on the semaphore — crews that hold it are tracked
+# by the semaphore itself — so MAX_QUEUED_CREWS is a true queue depth.
+MAX_CONCURRENT_CREWS = int(os.getenv("MAX_CONCURRENT_CREWS", "4"))
+MAX_QUEUED_CREWS = int(os.getenv("MAX_QUEUED_CREWS", "8"))
+_CREW_SEM = asyncio.Semaphore(MAX_CONCURRENT_CREWS)
+_crews_waiting = 0
+
+# Result cache: re-running an identical production would re-pay every LLM
+# call, so finished results are cached by input hash for RESULT_CACHE_TTL
+# seconds (Redis when configured, otherwise in-process). The in-process
+# cache is bounded: expired entries are swept on every insert and the
+# oldest entries are evicted past RESULT_CACHE_MAX_ENTRIES, so distinct
+# inputs can't grow memory without limit.
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+_local_result_cache: Dict[str, tuple] = {}
+
+def _cache_key(production_name: str, additional_context: Dict[str, Any]) -> str:
+    payload = production_name + json.dumps(additional_context, sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8")).hexdigest()
+
+async def _cache_get(key: str):
+    """Return the cached crew result for key, or None on a miss."""
+    if app.state.redis is not None:
+        return await app.state.redis.get(key)
+    entry = _local_result_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, result = entry
+    if time.time() >= expires_at:
+        del _local_result_cache[key]
+        return None
+    return result
+
+async def _cache_set(key: str, result: str):
+    """Store a crew result under key for RESULT_CACHE_TTL seconds."""
+    if app.state.redis is not None:
+        await app.state.redis.setex(key, RESULT_CACHE_TTL, result)
+        return
+
+    # Sweep expired entries, then evict oldest-first (dict insertion
+    # order) until the new entry fits under the size bound
+    now = time.time()
+    for stale_key in [k for k, (expires_at, _) in _local_result_cache.items() if now >= expires_at]:
+        del _local_result_cache[stale_key]
+    while len(_local_result_cache) >= RESULT_CACHE_MAX_ENTRIES:
+        del _local_result_cache[next(iter(_local_result_cache))]
+
+    _local_result_cache[key] = (now + RESULT_CACHE_TTL, result)
+
+# Request models: the context schema is closed over known fields so the
+# validator walks concrete types instead of arbitrary nested Any values;
+# unknown keys are still accepted and passed through to the crew inputs
+class AdditionalContext(BaseModel):
+    model_config = ConfigDict(extra="allow", str_strip_whitespace=True)
+
+    setting: Optional[str] = Field(default=None, max_length=500, description="Where and when the production takes place")
+    era: Optional[str] = Field(default=None, max_length=200, description="Historical period for research and design")
+    genre: Optional[str] = Field(default=None, max_length=200, description="Musical genre or style of the production")
+    themes: Optional[List[str]] = Field(default=None, max_length=20, description="Major themes the production explores")
+    notes: Optional[str] = Field(default=None, max_length=5000, description="Free-form notes for the crew")
+
+    def as_inputs(self) -> Dict[str, Any]:
+        """Return the provided context fields (declared and extra) as a dict."""
+        return self.model_dump(exclude_none=True)
 
-# Request model
 class CrewRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     production_name: str = Field(..., description="The name of the musical theater production")
-    additional_context: Dict[str, Any] = Field(
-        default={}, description="Optional additional context for the production"
+    additional_context: AdditionalContext = Field(
+        default_factory=AdditionalContext, description="Optional additional context for the production"
     )
 
 # Response model
 class CrewResponse(BaseModel):
     result: str = Field(..., description="The result from CrewAI execution")
     execution_time: float = Field(..., description="Execution time in seconds")
+    cache_hit: bool = Field(default=False, description="Whether the result was served from cache")
 
 @app.get("/")
 async def root():
     """Health check endpoint"""
     return {"status": "ok", "message": "Musical Theater CrewAI API is running"}
 
-@app.post("/trigger-crew", response_model=CrewResponse)
-async def trigger_crew(request: CrewRequest, api_keys: bool = Depends(verify_api_keys)):
+@app.post("/trigger-crew", response_model=CrewResponse, response_class=ORJSONResponse)
+async def trigger_crew(request: CrewRequest):
     """
     Trigger a Musical Theater CrewAI process
     
     This endpoint accepts a production name and additional context, then:
-    1. Creates a musical theater crew with the appropriate agents and tasks
-    2. Executes the crew asynchronously
-    3. Returns the result
+    1. Creates per-role musical theater crews with the appropriate agents and tasks
+    2. Executes the independent role crews concurrently, then the reviewing roles
+    3. Returns the combined result
     """
+    global _crews_waiting
+
+    # Serve repeat runs of an identical production from the result cache
+    additional_context = request.additional_context.as_inputs()
+    cache_key = _cache_key(request.production_name, additional_context)
+    cached_result = await _cache_get(cache_key)
+    if cached_result is not None:
+        logger.info("Cache hit for production: %s", request.production_name)
+        return CrewResponse(result=cached_result, execution_time=0.0, cache_hit=True)
+
+    if _crews_waiting >= MAX_QUEUED_CREWS:
+        raise HTTPException(status_code=503, detail="Too many queued crew requests, try again later")
+
     try:
-        logger.info(f"Received request for production: {request.production_name}")
-        
-        # Create the musical theater crew
-        crew = create_musical_theater_crew(request.production_name)
-        
+        logger.info("Received request for production: %s", request.production_name)
+
         # Start timing the execution
-        start_time = asyncio.get_event_loop().time()
-        
-        # Execute the crew asynchronously and wait for the result
-        inputs = {"production_name": request.production_name, **request.additional_context}
-        result = await crew.kickoff_async(inputs=inputs)
+        start_time = time.perf_counter()
+
+        # Execute the role crews concurrently and wait for the combined result
+        inputs = additional_context | {"production_name": request.production_name}
+        _crews_waiting += 1
+        dequeued = False
+        try:
+            async with _CREW_SEM:
+                # Holding the semaphore means running, not queued
+                _crews_waiting -= 1
+                dequeued = True
+                result = await create_and_run_crews(inputs)
+        finally:
+            if not dequeued:
+                _crews_waiting -= 1
+
+        await _cache_set(cache_key, result)
         
         # Calculate execution time
-        execution_time = asyncio.get_event_loop().time() - start_time
-        logger.info(f"CrewAI execution completed in {execution_time:.2f} seconds")
+        execution_time = time.perf_counter() - start_time
+        logger.info("CrewAI execution completed in %.2f seconds", execution_time)
         
         return CrewResponse(result=result, execution_time=execution_time)
     
     except Exception as e:
-        logger.error(f"Error during CrewAI execution: {str(e)}", exc_info=True)
+        logger.error("Error during CrewAI execution: %s", e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail=f"An error occurred during CrewAI execution: {str(e)}",
         )
 
+# SSE flush tuning: flush roughly every 50ms, with a per-flush batch limit
+# that grows geometrically (1 -> 3 -> 9 -> ... -> 50) so HTTP framing
+# overhead does not dominate chatty step streams.
+SSE_FLUSH_INTERVAL = 0.05
+SSE_BATCH_GROWTH = 3
+SSE_MAX_BATCH = 50
+
+async def _sse_generator(step_queue: asyncio.Queue, crew_task: "asyncio.Task"):
+    """Yield agent steps as SSE events while the crew runs, then the final result."""
+    try:
+        batch = []
+        flush_size = 1
+        while not (crew_task.done() and step_queue.empty()):
+            try:
+                step = await asyncio.wait_for(step_queue.get(), timeout=SSE_FLUSH_INTERVAL)
+                batch.append(step)
+            except asyncio.TimeoutError:
+                pass
+
+            if batch and (len(batch) >= flush_size or step_queue.empty()):
+                yield f"event: step\ndata: {json.dumps(batch)}\n\n"
+                batch = []
+                flush_size = min(flush_size * SSE_BATCH_GROWTH, SSE_MAX_BATCH)
+
+        if batch:
+            yield f"event: step\ndata: {json.dumps(batch)}\n\n"
+
+        try:
+            result = await crew_task
+            yield f"event: result\ndata: {json.dumps({'result': result})}\n\n"
+        except Exception as e:
+            logger.error("Error during streamed CrewAI execution: %s", e, exc_info=True)
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+    finally:
+        # A client disconnect kills this generator mid-stream; don't let
+        # the abandoned crew hold a semaphore slot for the rest of a
+        # multi-minute run
+        if not crew_task.done():
+            crew_task.cancel()
+
+@app.post("/trigger-crew/stream")
+async def trigger_crew_stream(request: CrewRequest):
+    """
+    Trigger a Musical Theater CrewAI process with streamed progress
+
+    Same workflow as /trigger-crew, but agent steps are emitted as
+    server-sent events while the crew runs, so the client sees the first
+    task's output after one task's latency instead of waiting for the
+    whole crew to finish.
+    """
+    global _crews_waiting
+
+    # Serve repeat runs from the result cache as a single result event
+    additional_context = request.additional_context.as_inputs()
+    cache_key = _cache_key(request.production_name, additional_context)
+    cached_result = await _cache_get(cache_key)
+    if cached_result is not None:
+        logger.info("Cache hit for production: %s", request.production_name)
+
+        async def cached_stream():
+            yield f"event: result\ndata: {json.dumps({'result': cached_result, 'cache_hit': True})}\n\n"
+
+        return StreamingResponse(cached_stream(), media_type="text/event-stream")
+
+    if _crews_waiting >= MAX_QUEUED_CREWS:
+        raise HTTPException(status_code=503, detail="Too many queued crew requests, try again later")
+
+    logger.info("Received streaming request for production: %s", request.production_name)
+
+    step_queue: asyncio.Queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    # Step callbacks fire on crew worker threads, so hop back to the loop
+    def step_callback(step):
+        loop.call_soon_threadsafe(step_queue.put_nowait, str(step))
+
+    inputs = additional_context | {"production_name": request.production_name}
+
+    # Reserve the queue slot synchronously, before the crew task is spawned,
+    # so a burst of stream requests can't all pass the admission check first
+    _crews_waiting += 1
+
+    async def run_crews():
+        global _crews_waiting
+        dequeued = False
+        try:
+            async with _CREW_SEM:
+                # Holding the semaphore means running, not queued
+                _crews_waiting -= 1
+                dequeued = True
+                result = await create_and_run_crews(inputs, step_callback=step_callback)
+        finally:
+            if not dequeued:
+                _crews_waiting -= 1
+        await _cache_set(cache_key, result)
+        return result
+
+    crew_task = asyncio.create_task(run_crews())
+
+    return StreamingResponse(_sse_generator(step_queue, crew_task), media_type="text/event-stream")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file